@@ -1,22 +1,41 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from PIL import Image
+import asyncio
 import io
+import json
 import os
 import requests
 import base64
 import pytesseract
 import cv2
 import numpy as np
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_path, pdfinfo_from_path
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+import shutil
+import subprocess
+import tempfile
+import xml.etree.ElementTree as ET
 import logging
 from pathlib import Path
 from dotenv import load_dotenv
 import time
 import sys
 import traceback
+from scheduling import (
+    AdmissionController,
+    AdmissionRejected,
+    RequestCancelled,
+    RequestContext,
+    StageDeadlineExceeded,
+    StageScheduler,
+)
+from near_duplicates import PerceptualHashIndex, compute_perceptual_hash
 from textblob import TextBlob
 import nltk
 
@@ -56,6 +75,37 @@ pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "mistral")
 
+# Configure request scheduling
+STAGE_WORKERS = int(os.getenv("STAGE_WORKERS", os.cpu_count() or 2))
+# Summaries mostly wait on Ollama, so they get their own slots instead of CPU workers
+OLLAMA_WORKERS = int(os.getenv("OLLAMA_WORKERS", "2"))
+# Workers in each pool that bulk requests may never occupy, so interactive ones never wait behind them
+INTERACTIVE_RESERVED_WORKERS = int(os.getenv("INTERACTIVE_RESERVED_WORKERS", "1"))
+INTERACTIVE_DEADLINE_SECONDS = float(os.getenv("INTERACTIVE_DEADLINE_SECONDS", "60"))
+BULK_DEADLINE_SECONDS = float(os.getenv("BULK_DEADLINE_SECONDS", "300"))
+ADMISSION_INITIAL_ESTIMATE_SECONDS = float(os.getenv("ADMISSION_INITIAL_ESTIMATE_SECONDS", "10"))
+DISCONNECT_POLL_SECONDS = 0.5
+
+# Configure near-duplicate reuse (set PHASH_MAX_DISTANCE below 0 to disable)
+PHASH_INDEX_PATH = BASE_DIR / "phash_index.jsonl"
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "10"))
+# Largest local gray-level difference from the stored upload that still counts as the same image
+PHASH_MAX_GLYPH_DIFFERENCE = float(os.getenv("PHASH_MAX_GLYPH_DIFFERENCE", "16"))
+PHASH_MAX_ENTRIES = int(os.getenv("PHASH_MAX_ENTRIES", "50000"))
+
+# Messages process_with_ollama_text returns instead of a real summary
+SUMMARY_FAILURE_PREFIXES = ("Error", "Could not connect to Ollama", "Summary generation failed")
+
+# Lower value is served first; each class gets its own end-to-end time budget
+PRIORITY_CLASSES = {
+    "interactive": (0, INTERACTIVE_DEADLINE_SECONDS),
+    "bulk": (1, BULK_DEADLINE_SECONDS),
+}
+
+# Share of the remaining request budget given to each stage, in pipeline order.
+# Time a stage does not use rolls over to the stages after it.
+STAGE_BUDGET_SHARES = [("ocr", 0.5), ("spelling", 0.1), ("summary", 0.4)]
+
 app = FastAPI()
 
 # CORS middleware
@@ -73,9 +123,69 @@ app.mount("/processed", StaticFiles(directory=str(PROCESSED_DIR)), name="process
 
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.pdf', '.tiff', '.tif'}
 
+# Resolution used when rasterising PDF pages (also the pdf2image default)
+PDF_RASTER_DPI = 200
+
+# Most per-page PDFs handed to a single pdfunite call when assembling the searchable PDF
+PDF_MERGE_BATCH = 100
+
+# TrueType font for the invisible text layer. Only characters the font covers end up
+# searchable, so point PDF_TEXT_FONT at a font for the scripts you OCR (e.g. Noto Sans).
+PDF_TEXT_FONT_CANDIDATES = [
+    os.getenv("PDF_TEXT_FONT", ""),
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSans-Regular.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    r"C:\Windows\Fonts\arial.ttf",
+]
+
+def register_text_layer_font() -> str:
+    """Register the first usable Unicode TrueType font, falling back to Latin-1-only Helvetica"""
+    for font_path in PDF_TEXT_FONT_CANDIDATES:
+        if not font_path or not os.path.exists(font_path):
+            continue
+        try:
+            pdfmetrics.registerFont(TTFont("TextLayer", font_path))
+            logger.info(f"Using {font_path} for the searchable PDF text layer")
+            return "TextLayer"
+        except Exception as e:
+            logger.warning(f"Could not load text layer font {font_path}: {str(e)}")
+    logger.warning("No TrueType font found for the searchable PDF; only Latin-1 text will be searchable")
+    return "Helvetica"
+
+PDF_TEXT_FONT_NAME = register_text_layer_font()
+
+scheduler = StageScheduler(STAGE_WORKERS, "cpu", INTERACTIVE_RESERVED_WORKERS)
+ollama_scheduler = StageScheduler(OLLAMA_WORKERS, "ollama", INTERACTIVE_RESERVED_WORKERS)
+admission = AdmissionController([scheduler, ollama_scheduler], ADMISSION_INITIAL_ESTIMATE_SECONDS)
+
+phash_index = PerceptualHashIndex(
+    PHASH_INDEX_PATH, PHASH_MAX_DISTANCE, PHASH_MAX_GLYPH_DIFFERENCE, PHASH_MAX_ENTRIES
+)
+
+async def watch_for_disconnect(request: Request, ctx: RequestContext):
+    """Cancel the request's in-flight and queued work once the client goes away"""
+    while not ctx.cancelled.is_set():
+        if await request.is_disconnected():
+            logger.info("Client disconnected, cancelling remaining work")
+            ctx.cancelled.set()
+            scheduler.cancel(ctx)
+            ollama_scheduler.cancel(ctx)
+            return
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
 def is_valid_file(filename: str) -> bool:
     return any(filename.lower().endswith(ext) for ext in ALLOWED_EXTENSIONS)
 
+def save_upload(contents: bytes, original_filename: str) -> Path:
+    """Save uploaded file"""
+    timestamp = int(time.time())
+    filename = f"{timestamp}_{original_filename}"
+    file_path = UPLOAD_DIR / filename
+    with open(file_path, "wb") as f:
+        f.write(contents)
+    return file_path
+
 def preprocess_image(image: Image.Image) -> Image.Image:
     """Preprocess image for better OCR results"""
     try:
@@ -98,21 +208,170 @@ def preprocess_image(image: Image.Image) -> Image.Image:
         logger.error(traceback.format_exc())
         return image
 
-def extract_text_tesseract(image: Image.Image) -> str:
-    """Extract text using Tesseract OCR"""
+def iter_document_pages(content: bytes, filename: str):
+    """Yield (page_image, dpi) one page at a time so only a single page is decoded in memory"""
+    if filename.lower().endswith('.pdf'):
+        # Write the PDF once; convert_from_bytes would copy it to a new temp file for every page
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pdf_path = Path(tmp_dir) / "document.pdf"
+            pdf_path.write_bytes(content)
+            page_count = pdfinfo_from_path(str(pdf_path)).get("Pages", 0)
+            if not page_count:
+                raise Exception("Could not convert PDF to images")
+            for page_number in range(1, page_count + 1):
+                pages = convert_from_path(
+                    str(pdf_path),
+                    dpi=PDF_RASTER_DPI,
+                    first_page=page_number,
+                    last_page=page_number
+                )
+                if pages:
+                    yield pages[0], PDF_RASTER_DPI
+    else:
+        image = Image.open(io.BytesIO(content))
+        dpi = image.info.get('dpi', (72, 72))[0] or 72
+        yield image, dpi
+
+def ocr_page_with_layout(image: Image.Image, output_base: Path, ctx: RequestContext = None) -> str:
+    """Run a single Tesseract pass that writes plain text, hOCR and ALTO for one page.
+
+    Leaves ``<output_base>.hocr`` and ``<output_base>.xml`` on disk and returns the text.
+    """
     try:
-        # Preprocess image
         processed_image = preprocess_image(image)
-        
-        # Extract text
-        text = pytesseract.image_to_string(processed_image)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = Path(tmp_dir) / "page.png"
+            processed_image.save(input_path, format='PNG')
+            process = subprocess.Popen(
+                [TESSERACT_PATH, str(input_path), str(output_base), "txt", "hocr", "alto"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE
+            )
+            while True:
+                try:
+                    _, stderr = process.communicate(timeout=0.2)
+                    break
+                except subprocess.TimeoutExpired:
+                    if ctx is None:
+                        continue
+                    try:
+                        ctx.check()
+                    except (RequestCancelled, StageDeadlineExceeded):
+                        process.kill()
+                        process.communicate()
+                        raise
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args, stderr=stderr)
+        text_path = output_base.with_suffix(".txt")
+        text = text_path.read_text(encoding="utf-8")
+        text_path.unlink()
         return text.strip()
+    except (RequestCancelled, StageDeadlineExceeded):
+        raise
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Tesseract OCR error: {e.stderr.decode(errors='replace')}")
+        return ""
     except Exception as e:
         logger.error(f"Tesseract OCR error: {str(e)}")
         logger.error(traceback.format_exc())
         return ""
 
-def process_with_ollama_image(image: Image.Image, prompt: str) -> str:
+def parse_hocr_words(hocr_path: Path) -> list:
+    """Return (text, (x0, y0, x1, y1)) for every recognised word in an hOCR page"""
+    words = []
+    try:
+        root = ET.parse(hocr_path).getroot()
+    except (ET.ParseError, OSError) as e:
+        logger.error(f"Could not read hOCR output {hocr_path}: {e}")
+        return words
+
+    for element in root.iter():
+        if element.get('class') != 'ocrx_word':
+            continue
+        text = ''.join(element.itertext()).strip()
+        if not text:
+            continue
+        for prop in element.get('title', '').split(';'):
+            parts = prop.split()
+            if parts and parts[0] == 'bbox' and len(parts) == 5:
+                words.append((text, tuple(int(v) for v in parts[1:])))
+                break
+    return words
+
+def write_searchable_page(pdf_path: Path, image: Image.Image, dpi: float, words: list):
+    """Write a one-page PDF of the original page image with an invisible, selectable text layer"""
+    scale = 72.0 / dpi
+    page_width = image.width * scale
+    page_height = image.height * scale
+    pdf = canvas.Canvas(str(pdf_path), pagesize=(page_width, page_height))
+    pdf.drawImage(ImageReader(image), 0, 0, width=page_width, height=page_height)
+
+    for text, (x0, y0, x1, y1) in words:
+        box_width = (x1 - x0) * scale
+        font_size = max((y1 - y0) * scale, 1)
+        text_width = pdf.stringWidth(text, PDF_TEXT_FONT_NAME, font_size)
+        text_object = pdf.beginText()
+        text_object.setTextRenderMode(3)  # invisible
+        text_object.setFont(PDF_TEXT_FONT_NAME, font_size)
+        if text_width > 0:
+            text_object.setHorizScale(100.0 * box_width / text_width)
+        text_object.setTextOrigin(x0 * scale, page_height - y1 * scale)
+        text_object.textOut(text)
+        pdf.drawText(text_object)
+    pdf.showPage()
+    pdf.save()
+
+def merge_pdf_pages(page_paths: list, output_path: Path):
+    """Concatenate per-page PDFs with poppler's pdfunite, at most PDF_MERGE_BATCH inputs per call"""
+    paths = list(page_paths)
+    merge_round = 0
+    while len(paths) > 1:
+        merged = []
+        for i in range(0, len(paths), PDF_MERGE_BATCH):
+            batch = paths[i:i + PDF_MERGE_BATCH]
+            if len(batch) == 1:
+                merged.append(batch[0])
+                continue
+            target = output_path.with_name(f"merge_{merge_round}_{i // PDF_MERGE_BATCH:04d}.pdf")
+            subprocess.run(
+                ["pdfunite", *[str(path) for path in batch], str(target)],
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE
+            )
+            for path in batch:
+                path.unlink()
+            merged.append(target)
+        paths = merged
+        merge_round += 1
+    paths[0].replace(output_path)
+
+def stream_ollama_generate(payload: dict, ctx: RequestContext = None) -> str:
+    """Call Ollama's generate endpoint in streaming mode so the call can be aborted mid-generation"""
+    timeout = 30 if ctx is None else min(max(ctx.remaining(), 1), 30)
+    with requests.post(
+        f"{OLLAMA_HOST}/api/generate",
+        json={**payload, 'stream': True},
+        stream=True,
+        timeout=timeout
+    ) as response:
+        if response.status_code != 200:
+            raise Exception(f"Ollama API error: {response.text}")
+
+        chunks = []
+        for line in response.iter_lines():
+            # Leaving the with-block closes the connection, which stops Ollama generating
+            if ctx is not None:
+                ctx.check()
+            if not line:
+                continue
+            data = json.loads(line)
+            chunks.append(data.get('response', ''))
+            if data.get('done'):
+                break
+        return ''.join(chunks)
+
+def process_with_ollama_image(image: Image.Image, prompt: str, ctx: RequestContext = None) -> str:
     """Process image content using Ollama"""
     try:
         # Convert image to bytes
@@ -124,9 +383,8 @@ def process_with_ollama_image(image: Image.Image, prompt: str) -> str:
         content_base64 = base64.b64encode(img_byte_arr).decode('utf-8')
         
         # Call Ollama API with a more conversational prompt
-        response = requests.post(
-            f"{OLLAMA_HOST}/api/generate",
-            json={
+        return stream_ollama_generate(
+            {
                 'model': OLLAMA_MODEL,
                 'prompt': f"""You are a helpful assistant that analyzes images and documents. 
                 Please analyze this image and provide a detailed summary of its contents.
@@ -134,17 +392,12 @@ def process_with_ollama_image(image: Image.Image, prompt: str) -> str:
                 If there are any diagrams or visual elements, please describe them.
                 Format your response in a clear, structured way with bullet points.
 
-                Image data: {content_base64}""",
-                'stream': False
+                Image data: {content_base64}"""
             },
-            timeout=30
+            ctx
         )
-        
-        if response.status_code != 200:
-            raise Exception(f"Ollama API error: {response.text}")
-        
-        result = response.json()
-        return result.get('response', '')
+    except (RequestCancelled, StageDeadlineExceeded):
+        raise
     except requests.exceptions.ConnectionError:
         logger.error("Could not connect to Ollama")
         return ""
@@ -153,13 +406,12 @@ def process_with_ollama_image(image: Image.Image, prompt: str) -> str:
         logger.error(traceback.format_exc())
         return ""
 
-def process_with_ollama_text(text: str, prompt: str) -> str:
+def process_with_ollama_text(text: str, prompt: str, ctx: RequestContext = None) -> str:
     """Process text content using Ollama"""
     try:
         # Call Ollama API with a more conversational prompt
-        response = requests.post(
-            f"{OLLAMA_HOST}/api/generate",
-            json={
+        summary = stream_ollama_generate(
+            {
                 'model': OLLAMA_MODEL,
                 'prompt': f"""You are a helpful assistant that summarizes documents. 
                 Please analyze the following text and provide a comprehensive summary.
@@ -174,26 +426,20 @@ def process_with_ollama_text(text: str, prompt: str) -> str:
                 2. Key points and arguments
                 3. Important details and conclusions
                 4. Any notable insights or implications""",
-                'stream': False,
                 'temperature': 0.7,
                 'max_tokens': 1000
             },
-            timeout=30
+            ctx
         )
         
-        if response.status_code != 200:
-            logger.error(f"Ollama API error: {response.text}")
-            raise Exception(f"Ollama API error: {response.text}")
-        
-        result = response.json()
-        summary = result.get('response', '')
-        
         if not summary:
             logger.error("Empty summary received from Ollama")
             return "Summary generation failed. Please try again."
             
         logger.info(f"Generated summary: {summary}")
         return summary
+    except (RequestCancelled, StageDeadlineExceeded):
+        raise
     except requests.exceptions.ConnectionError:
         logger.error("Could not connect to Ollama")
         return "Could not connect to Ollama. Please check if Ollama is running."
@@ -202,89 +448,202 @@ def process_with_ollama_text(text: str, prompt: str) -> str:
         logger.error(traceback.format_exc())
         return f"Error generating summary: {str(e)}"
 
-def process_document_content(content: bytes, filename: str) -> str:
-    """Process document content using multiple methods"""
+def process_document_content(content: bytes, filename: str, export_dir: Path, ctx: RequestContext = None):
+    """Process document content using multiple methods.
+
+    Every page goes through one Tesseract pass whose hOCR/ALTO output and one-page
+    searchable PDF are written to export_dir (a folder under PROCESSED_DIR) as soon as
+    the page is done; the page PDFs are merged at the end. Returns the extracted text
+    and the export URLs. A page that cannot be rendered to PDF only drops the searchable PDF.
+    """
+    export_url = f"/processed/{export_dir.name}"
+    pdf_path = export_dir / "searchable.pdf"
+    exports = {"searchable_pdf": None, "hocr": [], "alto": []}
+    page_pdfs = []
+    searchable = True
     try:
-        # Convert PDF to image if needed
-        if filename.lower().endswith('.pdf'):
-            images = convert_from_bytes(content)
-            if not images:
-                raise Exception("Could not convert PDF to images")
-            content = images[0]  # Use first page
-        else:
-            content = Image.open(io.BytesIO(content))
-        
-        # Try Tesseract OCR first
-        text = extract_text_tesseract(content)
-        
+        page_texts = []
+        first_page = None
+        for page_number, (image, dpi) in enumerate(iter_document_pages(content, filename), start=1):
+            if ctx is not None:
+                ctx.check()
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            if first_page is None:
+                first_page = image
+
+            output_base = export_dir / f"page_{page_number:04d}"
+            page_texts.append(ocr_page_with_layout(image, output_base, ctx))
+
+            # Only advertise layout files Tesseract actually wrote
+            words = []
+            hocr_path = output_base.with_suffix(".hocr")
+            if hocr_path.exists():
+                words = parse_hocr_words(hocr_path)
+                exports["hocr"].append(f"{export_url}/{hocr_path.name}")
+            alto_path = output_base.with_suffix(".xml")
+            if alto_path.exists():
+                exports["alto"].append(f"{export_url}/{alto_path.name}")
+
+            if searchable:
+                page_pdf = output_base.with_suffix(".pdf")
+                try:
+                    write_searchable_page(page_pdf, image, dpi, words)
+                    page_pdfs.append(page_pdf)
+                except Exception as e:
+                    # A searchable PDF with pages missing would be misleading, so skip it entirely
+                    logger.error(f"Could not write searchable PDF page {page_number}: {str(e)}")
+                    searchable = False
+                    for path in [*page_pdfs, page_pdf]:
+                        path.unlink(missing_ok=True)
+                    page_pdfs = []
+
+        if first_page is None:
+            raise Exception("Document contains no pages")
+        if searchable:
+            try:
+                merge_pdf_pages(page_pdfs, pdf_path)
+                exports["searchable_pdf"] = f"{export_url}/{pdf_path.name}"
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.error(f"Could not assemble searchable PDF: {str(e)}")
+
+        text = "\n\n".join(t for t in page_texts if t)
+
         # If Tesseract fails or returns empty result, try Ollama
         if not text:
             logger.info("Tesseract OCR failed, trying Ollama...")
-            text = process_with_ollama_image(content, """Please analyze this image and extract all text content from it. 
+            text = process_with_ollama_image(first_page, """Please analyze this image and extract all text content from it. 
             If there are any handwritten notes, please transcribe them as accurately as possible.
             If there are any printed text, please extract it exactly as it appears.
             If there are any numbers or special characters, please include them.
-            Please format the output as plain text, maintaining the original structure where possible.""")
+            Please format the output as plain text, maintaining the original structure where possible.""", ctx)
         
-        return text
+        return text, exports
+    except (RequestCancelled, StageDeadlineExceeded):
+        raise
     except Exception as e:
         logger.error(f"Document processing error: {str(e)}")
         logger.error(traceback.format_exc())
         raise
 
-def correct_spelling(text: str) -> str:
-    """Corrects spelling in the given text using TextBlob."""
+def correct_spelling(text: str, ctx: RequestContext = None) -> str:
+    """Corrects spelling in the given text using TextBlob.
+
+    Works line by line so a cancelled or out-of-time request stops between lines;
+    on a deadline the lines not reached yet are returned uncorrected.
+    """
     if not text.strip():
         return text
+    lines = text.split("\n")
+    corrected_lines = []
     try:
-        blob = TextBlob(text)
-        corrected_text = str(blob.correct())
+        for line in lines:
+            if ctx is not None:
+                ctx.check()
+            corrected_lines.append(str(TextBlob(line).correct()) if line.strip() else line)
         logger.info("Spelling corrected successfully.")
-        return corrected_text
+        return "\n".join(corrected_lines)
+    except StageDeadlineExceeded:
+        logger.warning(f"Spelling correction ran out of time after {len(corrected_lines)} of {len(lines)} lines")
+        return "\n".join(corrected_lines + lines[len(corrected_lines):])
+    except RequestCancelled:
+        raise
     except Exception as e:
         logger.error(f"Spelling correction failed: {str(e)}")
         logger.error(traceback.format_exc())
         return text # Return original text if correction fails
 
 @app.post("/process-document")
-async def process_document(file: UploadFile = File(...)):
-    try:
-        if not file:
-            raise HTTPException(status_code=400, detail="No file provided")
-        
-        # Validate file type
-        if not is_valid_file(file.filename):
-            raise HTTPException(
-                status_code=400,
-                detail=f"Invalid file type. Supported types: {', '.join(ALLOWED_EXTENSIONS)}"
-            )
+async def process_document(
+    request: Request,
+    file: UploadFile = File(...),
+    priority: str = Query("interactive", description="Scheduling class: interactive or bulk")
+):
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid priority. Supported values: {', '.join(PRIORITY_CLASSES)}"
+        )
 
-        # Read file contents
-        contents = await file.read()
+    if not file:
+        raise HTTPException(status_code=400, detail="No file provided")
 
-        # Save uploaded file
-        timestamp = int(time.time())
-        filename = f"{timestamp}_{file.filename}"
-        file_path = UPLOAD_DIR / filename
-        with open(file_path, "wb") as f:
-            f.write(contents)
+    # Validate file type
+    if not is_valid_file(file.filename):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type. Supported types: {', '.join(ALLOWED_EXTENSIONS)}"
+        )
+
+    # Read file contents
+    contents = await file.read()
+
+    # Reuse results of an already processed near-duplicate before taking a pipeline slot
+    loop = asyncio.get_running_loop()
+    fingerprint = None
+    if phash_index.enabled:
+        fingerprint = await loop.run_in_executor(None, compute_perceptual_hash, contents, file.filename)
+    if fingerprint is not None:
+        duplicate = await loop.run_in_executor(None, phash_index.find, *fingerprint, contents)
+        if duplicate is not None:
+            distance, previous = duplicate
+            logger.info(f"Reusing results of {previous['file_path']} (distance {distance})")
+            file_path = save_upload(contents, file.filename)
+            return {
+                **previous,
+                "file_path": str(file_path),
+                "reused": True,
+                "reused_from": previous["file_path"],
+                "hash_distance": distance
+            }
+
+    priority_level, budget_seconds = PRIORITY_CLASSES[priority]
+    ctx = RequestContext(priority_level, budget_seconds, STAGE_BUDGET_SHARES)
+    try:
+        admission.admit(ctx)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy, please retry later",
+            headers={"Retry-After": str(max(int(e.retry_after), 1))}
+        )
+    watcher = asyncio.create_task(watch_for_disconnect(request, ctx))
+    completed = False
+    export_dir = None
+    try:
+        file_path = save_upload(contents, file.filename)
+        # mkdtemp creates a fresh folder, so concurrent uploads of the same name never share one
+        export_dir = Path(tempfile.mkdtemp(prefix=f"{file_path.stem}_", dir=PROCESSED_DIR))
 
         # Process document
-        extracted_text = process_document_content(contents, file.filename)
+        ctx.start_stage("ocr")
+        extracted_text, exports = await scheduler.run(
+            ctx, process_document_content, contents, file.filename, export_dir, ctx
+        )
         if not extracted_text:
             raise HTTPException(status_code=400, detail="No text could be extracted from the document")
 
         # Correct spelling of the extracted text
-        corrected_text = correct_spelling(extracted_text)
+        ctx.start_stage("spelling")
+        try:
+            corrected_text = await scheduler.run(ctx, correct_spelling, extracted_text, ctx)
+        except StageDeadlineExceeded:
+            logger.warning("No time left for spelling correction, using original extracted text.")
+            corrected_text = extracted_text
         if not corrected_text:
              logger.warning("Corrected text is empty, using original extracted text.")
              corrected_text = extracted_text # Fallback to original if corrected text is empty
 
         # Generate summary directly from the corrected text
         logger.info("Generating summary from extracted text...")
-        summary = process_with_ollama_text(corrected_text, "")
+        ctx.start_stage("summary")
+        try:
+            summary = await ollama_scheduler.run(ctx, process_with_ollama_text, corrected_text, "", ctx)
+        except StageDeadlineExceeded as e:
+            summary = f"Error generating summary: {str(e)}"
         
-        if not summary or summary.startswith("Error"):
+        summary_failed = not summary or summary.startswith(SUMMARY_FAILURE_PREFIXES)
+        if summary_failed:
             logger.error(f"Summary generation failed: {summary}")
             summary = "" + corrected_text[:200] + "..." if corrected_text else "No text extracted to summarize."
 
@@ -295,16 +654,37 @@ async def process_document(file: UploadFile = File(...)):
         result = {
             "original_text": corrected_text, # Use corrected text here
             "summary": summary,
-            "file_path": str(file_path)
+            "file_path": str(file_path),
+            "exports": exports,
+            "reused": False
         }
+
+        # Only index complete results so a fallback summary is never served again
+        if fingerprint is not None and not summary_failed:
+            await loop.run_in_executor(None, phash_index.add, *fingerprint, result)
         
+        completed = True
         return result
     except HTTPException as he:
         raise he
+    except RequestCancelled:
+        logger.info("Request cancelled by client disconnect")
+        raise HTTPException(status_code=499, detail="Client closed request")
+    except StageDeadlineExceeded as e:
+        logger.warning(f"Request deadline exceeded: {str(e)}")
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         logger.error(f"Error processing document: {str(e)}")
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        watcher.cancel()
+        scheduler.cancel(ctx)
+        ollama_scheduler.cancel(ctx)
+        admission.release(ctx, completed)
+        # Exports of a failed, cancelled or timed-out request are never linked, so drop them
+        if export_dir is not None and not completed:
+            shutil.rmtree(export_dir, ignore_errors=True)
 
 @app.get("/health")
 async def health_check():
@@ -324,7 +704,12 @@ async def health_check():
             "tesseract": f"available (version {tesseract_version})",
             "ollama": ollama_status,
             "upload_dir": str(UPLOAD_DIR),
-            "processed_dir": str(PROCESSED_DIR)
+            "processed_dir": str(PROCESSED_DIR),
+            "scheduler": scheduler.stats(),
+            "ollama_scheduler": ollama_scheduler.stats(),
+            "admission_estimate_seconds": {
+                pool: round(estimate, 2) for pool, estimate in admission.service_estimates.items()
+            }
         }
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
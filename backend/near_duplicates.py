@@ -0,0 +1,223 @@
+"""Perceptual-hash index used to reuse results for re-encoded copies of earlier uploads."""
+import io
+import json
+import logging
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+PHASH_SIZE = 16  # low-frequency DCT block kept, giving a 256-bit hash
+PHASH_SAMPLE_SIZE = 64  # side of the grayscale thumbnail the DCT is taken over
+GLYPH_MAX_SIDE = 2400  # longest side the confirmation compares at
+GLYPH_BLUR_SIGMA = 0.7
+GLYPH_WINDOW = 6  # pixels; about one stroke of small print
+ASPECT_TOLERANCE = 0.02
+
+class BKTree:
+    """Metric tree over integer hashes for fast Hamming-distance range queries"""
+
+    def __init__(self):
+        self._root = None
+
+    @staticmethod
+    def distance(a: int, b: int) -> int:
+        return bin(a ^ b).count("1")
+
+    def add(self, value: int, item):
+        node = (value, item, {})
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            d = self.distance(value, current[0])
+            child = current[2].get(d)
+            if child is None:
+                current[2][d] = node
+                return
+            current = child
+
+    def search(self, value: int, max_distance: int) -> list:
+        """Return (distance, item) for every stored hash within max_distance, closest first"""
+        matches = []
+        pending = [self._root] if self._root is not None else []
+        while pending:
+            node_value, item, children = pending.pop()
+            d = self.distance(value, node_value)
+            if d <= max_distance:
+                matches.append((d, item))
+            # Triangle inequality: only children at distance d +/- max_distance can match
+            for child_distance, child in children.items():
+                if d - max_distance <= child_distance <= d + max_distance:
+                    pending.append(child)
+        return sorted(matches, key=lambda match: match[0])
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Orthonormal DCT-II basis, so a 2D DCT is just two matrix products"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+_PHASH_DCT = _dct_matrix(PHASH_SAMPLE_SIZE)
+
+def compute_perceptual_hash(content: bytes, filename: str):
+    """Compute a pHash from a downscaled grayscale decode; returns (hash, aspect) or None"""
+    if filename.lower().endswith('.pdf'):
+        return None
+    try:
+        image = Image.open(io.BytesIO(content))
+        aspect = image.width / image.height
+        # Lets JPEG decode straight to a reduced size instead of full resolution
+        image.draft('L', (PHASH_SAMPLE_SIZE * 4, PHASH_SAMPLE_SIZE * 4))
+        small = image.convert('L').resize((PHASH_SAMPLE_SIZE, PHASH_SAMPLE_SIZE), Image.Resampling.LANCZOS)
+        pixels = np.asarray(small, dtype=np.float64)
+        coefficients = (_PHASH_DCT @ pixels @ _PHASH_DCT.T)[:PHASH_SIZE, :PHASH_SIZE].flatten()
+        # Compare against the median of the AC terms; the DC term only tracks brightness
+        bits = coefficients > np.median(coefficients[1:])
+        return int(''.join('1' if bit else '0' for bit in bits), 2), aspect
+    except Exception as e:
+        logger.error(f"Perceptual hashing failed: {e}")
+        return None
+
+def load_grayscale(source) -> np.ndarray:
+    """Decode an image (bytes or a path) to a full-resolution grayscale array"""
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    return np.asarray(Image.open(source).convert('L'))
+
+def glyph_difference(a: np.ndarray, b: np.ndarray) -> float:
+    """Largest local gray-level difference between two images, measured at glyph scale.
+
+    Both images are area-resized to the smaller one's size (capped at GLYPH_MAX_SIDE) and
+    lightly blurred so re-encoding and resampling noise averages out. The score is the
+    mean absolute difference in the worst GLYPH_WINDOW-pixel window, which a single
+    changed digit on a printed page still dominates.
+    """
+    height = min(a.shape[0], b.shape[0])
+    width = min(a.shape[1], b.shape[1])
+    scale = min(1.0, GLYPH_MAX_SIDE / max(height, width))
+    size = (max(int(width * scale), 1), max(int(height * scale), 1))
+    a = cv2.GaussianBlur(cv2.resize(a, size, interpolation=cv2.INTER_AREA).astype(np.float32), (0, 0), GLYPH_BLUR_SIGMA)
+    b = cv2.GaussianBlur(cv2.resize(b, size, interpolation=cv2.INTER_AREA).astype(np.float32), (0, 0), GLYPH_BLUR_SIGMA)
+    return float(cv2.blur(np.abs(a - b), (GLYPH_WINDOW, GLYPH_WINDOW)).max())
+
+class PerceptualHashIndex:
+    """Persistent perceptual hash index of processed uploads whose results can be reused.
+
+    pHash only nominates candidates; a hit is confirmed by comparing the new upload with
+    the stored original upload at glyph scale. The BK-tree holds just the hash, aspect
+    ratio, original upload path and the entry's byte offset in the JSONL file; results
+    are read from disk on a confirmed hit. The file is compacted to the newest entries
+    once it holds more than max_entries.
+    """
+
+    def __init__(self, path: Path, max_distance: int, max_glyph_difference: float, max_entries: int):
+        self.path = path
+        self.max_distance = max_distance
+        self.max_glyph_difference = max_glyph_difference
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._tree = BKTree()
+        self._count = 0
+        if self.enabled:
+            with self._lock:
+                self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_distance >= 0
+
+    @staticmethod
+    def _parse(line: bytes):
+        """Return (hash, (aspect, source)) for a valid index line; raises ValueError otherwise"""
+        try:
+            entry = json.loads(line)
+            value = int(entry["hash"], 16)
+            aspect = float(entry["aspect"])
+            source = entry["result"]["file_path"]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"missing field {e}")
+        if not isinstance(source, str) or aspect <= 0:
+            raise ValueError("invalid aspect or file_path")
+        return value, (aspect, source)
+
+    def _load(self):
+        # Caller must hold self._lock
+        self._tree = BKTree()
+        self._count = 0
+        if not self.path.exists():
+            return
+        with open(self.path, "rb") as f:
+            offset = f.tell()
+            for line in iter(f.readline, b""):
+                try:
+                    value, (aspect, source) = self._parse(line)
+                    self._tree.add(value, (aspect, source, offset))
+                    self._count += 1
+                except ValueError as e:
+                    logger.warning(f"Skipping corrupt perceptual hash index entry at byte {offset}: {e}")
+                offset = f.tell()
+
+    def _compact(self):
+        """Rewrite the index with only the newest entries, leaving headroom before the next compaction"""
+        # Caller must hold self._lock
+        keep = max(self.max_entries * 9 // 10, 1)
+        with open(self.path, "rb") as f:
+            lines = f.readlines()[-keep:]
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.writelines(lines)
+        tmp_path.replace(self.path)
+        self._load()
+        logger.info(f"Compacted perceptual hash index to {self._count} entries")
+
+    def _read_result(self, offset: int, source: str) -> dict:
+        # Caller must hold self._lock; a compaction since the search makes the offset stale
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            result = json.loads(f.readline())["result"]
+        if result.get("file_path") != source:
+            raise ValueError("index entry moved by compaction")
+        return result
+
+    def find(self, value: int, aspect: float, content: bytes):
+        """Return (distance, result) for the closest confirmed near-duplicate of content, or None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            matches = self._tree.search(value, self.max_distance)
+        upload = None
+        for distance, (entry_aspect, source, offset) in matches:
+            if abs(entry_aspect - aspect) > ASPECT_TOLERANCE * aspect:
+                continue
+            try:
+                if upload is None:
+                    upload = load_grayscale(content)
+                if glyph_difference(upload, load_grayscale(source)) > self.max_glyph_difference:
+                    continue
+                with self._lock:
+                    result = self._read_result(offset, source)
+                return distance, result
+            except Exception as e:
+                logger.warning(f"Skipping near-duplicate candidate {source}: {e}")
+        return None
+
+    def add(self, value: int, aspect: float, result: dict):
+        if not self.enabled:
+            return
+        line = (json.dumps({"hash": format(value, "x"), "aspect": aspect, "result": result}) + "\n").encode("utf-8")
+        with self._lock:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(line)
+            self._tree.add(value, (aspect, result["file_path"], offset))
+            self._count += 1
+            if self._count > self.max_entries:
+                self._compact()
@@ -0,0 +1,176 @@
+"""Scheduling primitives for the document pipeline: per-request time budgets,
+prioritised stage workers, cancellation and admission control."""
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class RequestCancelled(Exception):
+    """Raised when the client has disconnected and its remaining work should be dropped"""
+
+class StageDeadlineExceeded(Exception):
+    """Raised when a stage runs past its share of the request time budget"""
+
+class AdmissionRejected(Exception):
+    """Raised when a request would wait longer in the queue than its deadline allows"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Projected wait of {retry_after:.1f}s exceeds the request deadline")
+        self.retry_after = retry_after
+
+class RequestContext:
+    """Per-request priority, time budget and cancellation flag shared with worker threads"""
+
+    def __init__(self, priority: int, budget_seconds: float, stage_shares: list):
+        self.priority = priority
+        self.stage_shares = stage_shares
+        self.deadline = time.monotonic() + budget_seconds
+        self.stage = None
+        self.stage_deadline = self.deadline
+        self.cancelled = threading.Event()
+        # Seconds spent holding a worker, per scheduler pool
+        self.busy_seconds = {}
+
+    def start_stage(self, stage: str):
+        """Give the stage its share of whatever budget is left"""
+        names = [name for name, _ in self.stage_shares]
+        shares = [share for _, share in self.stage_shares[names.index(stage):]]
+        now = time.monotonic()
+        self.stage = stage
+        self.stage_deadline = now + max(self.deadline - now, 0) * shares[0] / sum(shares)
+
+    def remaining(self) -> float:
+        return max(self.stage_deadline - time.monotonic(), 0)
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise RequestCancelled()
+        if time.monotonic() > self.stage_deadline:
+            raise StageDeadlineExceeded(f"Stage '{self.stage}' exceeded its time budget")
+
+class StageScheduler:
+    """Runs blocking pipeline stages on a fixed pool of worker threads, highest priority first.
+
+    Jobs already running are never preempted, so `reserved` workers are kept for priority 0
+    work: lower priorities can hold at most workers - reserved of them (at least one).
+    Time spent in jobs is added to the request's busy_seconds under the pool name.
+    """
+
+    def __init__(self, workers: int, pool: str, reserved: int = 0):
+        self.workers = workers
+        self.pool = pool
+        self.reserved = max(min(reserved, workers - 1), 0)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._queue = []
+        self._running = 0
+        self._running_low = 0
+        self._sequence = itertools.count()
+
+    async def run(self, ctx: RequestContext, fn, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            heapq.heappush(self._queue, (ctx.priority, next(self._sequence), ctx, fn, args, future, loop))
+            self._dispatch()
+        return await future
+
+    def cancel(self, ctx: RequestContext):
+        """Drop every queued job belonging to a request"""
+        with self._lock:
+            kept = []
+            for job in self._queue:
+                if job[2] is ctx:
+                    self._resolve(job, error=RequestCancelled())
+                else:
+                    kept.append(job)
+            heapq.heapify(kept)
+            self._queue = kept
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "reserved": self.reserved,
+                "running": self._running,
+                "queued": len(self._queue)
+            }
+
+    def _dispatch(self):
+        # Caller must hold self._lock
+        while self._running < self.workers and self._queue:
+            # The queue is ordered by priority, so a blocked low-priority head means nothing else can run
+            if self._queue[0][0] > 0 and self._running_low >= self.workers - self.reserved:
+                break
+            job = heapq.heappop(self._queue)
+            self._running += 1
+            if job[0] > 0:
+                self._running_low += 1
+            self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        priority, _, ctx, fn, args, _, _ = job
+        started = time.monotonic()
+        try:
+            ctx.check()
+            self._resolve(job, result=fn(*args))
+        except Exception as e:
+            self._resolve(job, error=e)
+        finally:
+            ctx.busy_seconds[self.pool] = ctx.busy_seconds.get(self.pool, 0.0) + time.monotonic() - started
+            with self._lock:
+                self._running -= 1
+                if priority > 0:
+                    self._running_low -= 1
+                self._dispatch()
+
+    @staticmethod
+    def _resolve(job, result=None, error=None):
+        future, loop = job[5], job[6]
+
+        def settle():
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        loop.call_soon_threadsafe(settle)
+
+class AdmissionController:
+    """Rejects requests up front when their projected queue wait would blow the deadline.
+
+    Every request passes through each scheduler pool once, so the projection adds up the
+    wait and service time of all pools, each with its own running service-time estimate.
+    """
+
+    def __init__(self, pools: list, initial_estimate: float):
+        self.pools = pools
+        self.service_estimates = {pool.pool: initial_estimate for pool in pools}
+        self._in_flight = {}
+
+    def projected_wait(self, priority: int) -> float:
+        ahead = sum(count for p, count in self._in_flight.items() if p <= priority)
+        behind = sum(count for p, count in self._in_flight.items() if p > priority)
+        wait = 0.0
+        for pool in self.pools:
+            # Lower-priority work is not preempted, so it can keep every worker it may use busy
+            waiting_on = ahead + min(behind, pool.workers - pool.reserved)
+            wait += waiting_on * self.service_estimates[pool.pool] / pool.workers
+        return wait
+
+    def admit(self, ctx: RequestContext):
+        wait = self.projected_wait(ctx.priority)
+        if wait + sum(self.service_estimates.values()) > ctx.deadline - time.monotonic():
+            raise AdmissionRejected(wait)
+        self._in_flight[ctx.priority] = self._in_flight.get(ctx.priority, 0) + 1
+
+    def release(self, ctx: RequestContext, completed: bool):
+        self._in_flight[ctx.priority] -= 1
+        if completed:
+            # Exponentially weighted average of the worker time a request needs in each pool
+            for name, estimate in self.service_estimates.items():
+                self.service_estimates[name] = 0.8 * estimate + 0.2 * ctx.busy_seconds.get(name, 0.0)
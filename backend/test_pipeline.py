@@ -0,0 +1,319 @@
+"""Unit tests for the pure pipeline helpers; they need neither Tesseract nor Ollama.
+
+Run with: python -m pytest test_pipeline.py
+"""
+import asyncio
+import io
+import random
+import threading
+import time
+
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+from near_duplicates import (
+    BKTree,
+    PerceptualHashIndex,
+    compute_perceptual_hash,
+    glyph_difference,
+    load_grayscale,
+)
+from scheduling import (
+    AdmissionController,
+    AdmissionRejected,
+    RequestCancelled,
+    RequestContext,
+    StageDeadlineExceeded,
+    StageScheduler,
+)
+
+SHARES = [("ocr", 0.5), ("spelling", 0.1), ("summary", 0.4)]
+
+
+def test_start_stage_splits_remaining_budget():
+    ctx = RequestContext(0, 10.0, SHARES)
+    ctx.start_stage("ocr")
+    assert ctx.remaining() == pytest.approx(5.0, abs=0.1)
+
+
+def test_unused_stage_time_rolls_over():
+    ctx = RequestContext(0, 10.0, SHARES)
+    ctx.start_stage("ocr")
+    # OCR finished instantly, so spelling gets 0.1 / (0.1 + 0.4) of the full budget
+    ctx.start_stage("spelling")
+    assert ctx.remaining() == pytest.approx(2.0, abs=0.1)
+    ctx.start_stage("summary")
+    assert ctx.remaining() == pytest.approx(10.0, abs=0.1)
+
+
+def test_check_reports_deadline_and_cancellation():
+    ctx = RequestContext(0, 0.0, SHARES)
+    ctx.start_stage("ocr")
+    time.sleep(0.01)
+    with pytest.raises(StageDeadlineExceeded):
+        ctx.check()
+    ctx.cancelled.set()
+    with pytest.raises(RequestCancelled):
+        ctx.check()
+
+
+def test_scheduler_runs_higher_priority_first():
+    async def scenario():
+        scheduler = StageScheduler(1, "cpu")
+        release = threading.Event()
+        order = []
+
+        def job(tag):
+            if tag == "blocker":
+                release.wait(5)
+            order.append(tag)
+
+        blocker = asyncio.ensure_future(scheduler.run(RequestContext(1, 30.0, SHARES), job, "blocker"))
+        await asyncio.sleep(0.05)
+        bulk = asyncio.ensure_future(scheduler.run(RequestContext(1, 30.0, SHARES), job, "bulk"))
+        interactive = asyncio.ensure_future(scheduler.run(RequestContext(0, 30.0, SHARES), job, "interactive"))
+        await asyncio.sleep(0.05)
+        release.set()
+        await asyncio.gather(blocker, bulk, interactive)
+        return order
+
+    assert asyncio.run(scenario()) == ["blocker", "interactive", "bulk"]
+
+
+def test_cancel_drops_queued_jobs():
+    async def scenario():
+        scheduler = StageScheduler(1, "cpu")
+        release = threading.Event()
+        calls = []
+        ctx = RequestContext(0, 30.0, SHARES)
+
+        blocker = asyncio.ensure_future(scheduler.run(RequestContext(0, 30.0, SHARES), release.wait, 5))
+        await asyncio.sleep(0.05)
+        queued = asyncio.ensure_future(scheduler.run(ctx, calls.append, "ran"))
+        await asyncio.sleep(0.05)
+        ctx.cancelled.set()
+        scheduler.cancel(ctx)
+        with pytest.raises(RequestCancelled):
+            await queued
+        release.set()
+        await blocker
+        return calls, scheduler.stats()
+
+    calls, stats = asyncio.run(scenario())
+    assert calls == []
+    assert stats["queued"] == 0
+
+
+def test_busy_time_is_tracked_per_pool():
+    async def scenario():
+        ctx = RequestContext(0, 30.0, SHARES)
+        await StageScheduler(1, "cpu").run(ctx, time.sleep, 0.05)
+        await StageScheduler(1, "ollama").run(ctx, time.sleep, 0.02)
+        return ctx.busy_seconds
+
+    busy = asyncio.run(scenario())
+    assert busy["cpu"] >= 0.05
+    assert 0.02 <= busy["ollama"] < 0.05
+
+
+def test_bulk_work_cannot_take_reserved_worker():
+    async def scenario():
+        scheduler = StageScheduler(2, "cpu", reserved=1)
+        release = threading.Event()
+        started = []
+
+        def job(tag):
+            started.append(tag)
+            if tag.startswith("bulk"):
+                release.wait(5)
+
+        bulk = [asyncio.ensure_future(scheduler.run(RequestContext(1, 30.0, SHARES), job, f"bulk{i}")) for i in range(3)]
+        await asyncio.sleep(0.05)
+        # Only one bulk job holds a worker; the interactive one starts on the reserved worker
+        await asyncio.wait_for(scheduler.run(RequestContext(0, 30.0, SHARES), job, "interactive"), 1)
+        stats = scheduler.stats()
+        release.set()
+        await asyncio.gather(*bulk)
+        return started, stats
+
+    started, stats = asyncio.run(scenario())
+    assert started[:2] == ["bulk0", "interactive"]
+    assert stats["queued"] == 2
+
+
+def test_admission_rejects_when_projected_wait_exceeds_deadline():
+    admission = AdmissionController([StageScheduler(1, "cpu")], initial_estimate=4.0)
+    admission.admit(RequestContext(0, 10.0, SHARES))
+    # One request ahead (4s) plus our own 4s still fits in 10s; a second one ahead does not
+    admission.admit(RequestContext(0, 10.0, SHARES))
+    with pytest.raises(AdmissionRejected):
+        admission.admit(RequestContext(0, 10.0, SHARES))
+
+
+def test_admission_counts_bulk_work_only_up_to_its_workers():
+    admission = AdmissionController([StageScheduler(2, "cpu", reserved=1)], initial_estimate=4.0)
+    for _ in range(5):
+        admission.admit(RequestContext(1, 100.0, SHARES))
+    # Five bulk requests can hold only one of the two workers: 4 * 1 / 2 = 2s wait
+    assert admission.projected_wait(0) == pytest.approx(2.0)
+    admission.admit(RequestContext(0, 7.0, SHARES))
+
+    unreserved = AdmissionController([StageScheduler(1, "cpu")], initial_estimate=4.0)
+    for _ in range(5):
+        unreserved.admit(RequestContext(1, 100.0, SHARES))
+    # Without a reserved worker the interactive request waits out a running bulk stage
+    with pytest.raises(AdmissionRejected):
+        unreserved.admit(RequestContext(0, 7.0, SHARES))
+
+
+def test_admission_includes_summary_pool():
+    cpu, ollama = StageScheduler(4, "cpu"), StageScheduler(1, "ollama")
+    admission = AdmissionController([cpu, ollama], initial_estimate=2.0)
+    admission.admit(RequestContext(0, 30.0, SHARES))
+    # The single Ollama slot dominates: 2 * 1/4 + 2 * 1/1
+    assert admission.projected_wait(0) == pytest.approx(2.5)
+
+    ctx = RequestContext(0, 30.0, SHARES)
+    ctx.busy_seconds = {"cpu": 2.0, "ollama": 12.0}
+    admission.release(ctx, completed=True)
+    assert admission.service_estimates == {"cpu": pytest.approx(2.0), "ollama": pytest.approx(4.0)}
+
+
+def make_form(seed, rewritten_field=None):
+    """A printed form with hand-drawn strokes in each field; one field can be written differently"""
+    image = Image.new('L', (1240, 1754), 250)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((80, 60, 1160, 110), fill=40)
+    for field in range(12):
+        y = 220 + field * 120
+        draw.line((80, y, 1160, y), fill=60, width=2)
+        rng = random.Random(seed * 100 + field + (999 if field == rewritten_field else 0))
+        x = 300
+        for _ in range(rng.randint(8, 14)):
+            x_end = x + rng.randint(15, 40)
+            draw.line((x, y - rng.randint(10, 50), x_end, y - rng.randint(10, 50)), fill=15, width=4)
+            x = x_end
+    return image.convert('RGB')
+
+
+def encode(image, fmt, **kwargs):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **kwargs)
+    return buffer.getvalue()
+
+
+def test_bktree_search_matches_brute_force():
+    rng = random.Random(7)
+    values = [rng.getrandbits(64) for _ in range(300)]
+    tree = BKTree()
+    for value in values:
+        tree.add(value, value)
+    for _ in range(20):
+        query = rng.choice(values) ^ rng.getrandbits(64) & rng.getrandbits(64) & rng.getrandbits(64)
+        expected = sorted(BKTree.distance(query, v) for v in values if BKTree.distance(query, v) <= 12)
+        assert [distance for distance, _ in tree.search(query, 12)] == expected
+
+
+def test_perceptual_hash_survives_jpeg_reencode():
+    form = make_form(1)
+    original, _ = compute_perceptual_hash(encode(form, 'PNG'), 'form.png')
+    reencoded, _ = compute_perceptual_hash(encode(form, 'JPEG', quality=40), 'form.jpg')
+    assert BKTree.distance(original, reencoded) <= 10
+
+
+def test_perceptual_hash_skips_pdfs():
+    assert compute_perceptual_hash(b'%PDF-1.4', 'scan.pdf') is None
+
+
+def make_invoice(total, font_size=20):
+    """A printed A4 invoice at 150 dpi whose only variable part is the total line"""
+    try:
+        font = ImageFont.load_default(size=font_size)
+    except TypeError:
+        pytest.skip("needs Pillow >= 10.1 for a scalable default font")
+    image = Image.new('RGB', (1240, 1754), 'white')
+    draw = ImageDraw.Draw(image)
+    y = 80
+    for item in range(30):
+        draw.text((80, y), f"Item {item + 1:02d}  Widget model {item * 37 % 97}  qty {item % 5 + 1}", font=font, fill='black')
+        y += font_size * 2
+    draw.text((80, y + 20), f"TOTAL DUE: ${total}", font=font, fill='black')
+    return image
+
+
+def store_upload(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return {"file_path": str(path)}
+
+
+@pytest.mark.parametrize("font_size, before, after", [(20, "100.00", "700.00"), (14, "1,250.00", "1,850.00")])
+def test_glyph_difference_catches_one_changed_digit(font_size, before, after):
+    original = load_grayscale(encode(make_invoice(before, font_size), 'PNG'))
+    reencoded = load_grayscale(encode(make_invoice(before, font_size), 'JPEG', quality=70))
+    changed = load_grayscale(encode(make_invoice(after, font_size), 'PNG'))
+    assert glyph_difference(original, reencoded) <= 16
+    assert glyph_difference(original, changed) > 16
+
+
+def test_index_reuses_reencoded_upload_after_reload(tmp_path):
+    index_path = tmp_path / "phash_index.jsonl"
+    index = PerceptualHashIndex(index_path, 10, 16, 100)
+    content = encode(make_form(3), 'PNG')
+    result = store_upload(tmp_path, "form.png", content)
+    index.add(*compute_perceptual_hash(content, 'form.png'), result)
+
+    reloaded = PerceptualHashIndex(index_path, 10, 16, 100)
+    copy = encode(make_form(3), 'JPEG', quality=70)
+    match = reloaded.find(*compute_perceptual_hash(copy, 'copy.jpg'), copy)
+    assert match is not None and match[1] == result
+
+
+def test_index_rejects_same_template_with_different_handwriting(tmp_path):
+    index = PerceptualHashIndex(tmp_path / "phash_index.jsonl", 64, 16, 100)
+    content = encode(make_form(4), 'PNG')
+    index.add(*compute_perceptual_hash(content, 'form.png'), store_upload(tmp_path, "form.png", content))
+
+    other = encode(make_form(4, rewritten_field=7), 'PNG')
+    # Even with a pHash distance limit loose enough to make it a candidate
+    assert index.find(*compute_perceptual_hash(other, 'other.png'), other) is None
+
+
+def test_index_rejects_invoice_with_different_total(tmp_path):
+    index = PerceptualHashIndex(tmp_path / "phash_index.jsonl", 64, 16, 100)
+    content = encode(make_invoice("100.00"), 'PNG')
+    index.add(*compute_perceptual_hash(content, 'invoice.png'), store_upload(tmp_path, "invoice.png", content))
+
+    other = encode(make_invoice("700.00"), 'PNG')
+    assert index.find(*compute_perceptual_hash(other, 'other.png'), other) is None
+
+
+def test_index_skips_bad_entries_and_missing_uploads(tmp_path):
+    index_path = tmp_path / "phash_index.jsonl"
+    content = encode(make_form(5), 'PNG')
+    value, aspect = compute_perceptual_hash(content, 'form.png')
+    index_path.write_text(
+        '{"hash": "%x", "result": {"file_path": "no-aspect.png"}}\n' % value
+        + 'not json\n'
+        + '{"hash": "%x", "aspect": %r, "result": {"file_path": "%s"}}\n' % (value, aspect, tmp_path / "deleted.png")
+    )
+    index = PerceptualHashIndex(index_path, 10, 16, 100)
+    assert index.find(value, aspect, content) is None
+
+
+def test_disabled_index_writes_nothing(tmp_path):
+    index_path = tmp_path / "phash_index.jsonl"
+    index = PerceptualHashIndex(index_path, -1, 16, 100)
+    index.add(1, 1.0, {"file_path": "a.png"})
+    assert not index_path.exists()
+    assert index.find(1, 1.0, b"") is None
+
+
+def test_index_compacts_to_newest_entries(tmp_path):
+    index_path = tmp_path / "phash_index.jsonl"
+    index = PerceptualHashIndex(index_path, 0, 16, 10)
+    for value in range(11):
+        index.add(value, 1.0, {"file_path": f"{value}.png"})
+    lines = index_path.read_text().splitlines()
+    assert len(lines) == 9
+    assert '"1.png"' not in lines[0] and '"10.png"' in lines[-1]